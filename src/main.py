@@ -1,32 +1,292 @@
 import os
+import hashlib
 import json
 import logging
 import re
+import string
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from types import MappingProxyType
 import pandas as pd
 import pytesseract
-from pdf2image import convert_from_path
+import xlsxwriter
+from pdf2image import convert_from_path, pdfinfo_from_path
 from PIL import Image
 from pytesseract import Output
 
-# Konfigurera logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(os.path.join('logs', f'invoice_helper_{datetime.now().strftime("%Y%m%d")}.log')),
-        logging.StreamHandler()
-    ]
-)
+try:
+    import tesserocr
+except ImportError:  # Valfritt beroende, pytesseract används som reserv
+    tesserocr = None
+
+# Calamine läser xlsx betydligt snabbare än openpyxl, men pandas stöder
+# engine='calamine' först från version 2.2
+_EXCEL_READ_ENGINE = None
+if tuple(int(part) for part in pd.__version__.split('.')[:2]) >= (2, 2):
+    try:
+        import python_calamine  # noqa: F401
+        _EXCEL_READ_ENGINE = 'calamine'
+    except ImportError:  # Valfritt beroende, pandas standardmotor används som reserv
+        pass
+
+try:
+    import orjson
+except ImportError:  # Valfritt beroende, json används som reserv
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+def _setup_logging():
+    """Konfigurerar loggning till konsolen och dagens loggfil i logs-mappen."""
+    if logging.getLogger().handlers:
+        return
+    
+    os.makedirs('logs', exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(
+                os.path.join('logs', f'invoice_helper_{datetime.now().strftime("%Y%m%d")}.log'),
+                encoding='utf-8'
+            ),
+            logging.StreamHandler()
+        ]
+    )
+
+# Licenstyperna i den ordning de redovisas
+_LICENSE_TYPES = (
+    'power_bi', 'power_automate_rpa', 'power_automate_plan', 'teams_rooms',
+    'teams_eea', 'copilot', 'ms365_eea', 'power_automate_prem'
+)
+
+# Licensmönster för nya formatet: SKU-rad med periodtyp, sedan indenterad produktnamn-rad.
+# SKU-raden ser likadan ut för alla licenstyper, så typerna slås ihop till ett
+# mönster där bara produktnamnet skiljer. Den namngivna grupp som matchat sist
+# anger licenstypen. Mönstret kompileras vid import och matchas mot texten i
+# versaler så att re.IGNORECASE inte behövs.
+_NEW_FORMAT_PATTERN = re.compile(
+    r'[A-Z0-9]+/SKUS/\d+\s+-\s+(?:CYCLE(?:FEE)?|CORRECTION|CORR|PURCHASEFEE)\s+\d{6}\s+-\s+\d{6}\s+'
+    r'(?P<quantity>\d+,\d+)\s+ST\s+(?P<unit_price>\d+[\s,]*\d*,\d+)\s+(?P<total>\d+[\s,]*\d*,\d+)\s*[\r\n]+\s*(?:'
+    r'(?P<power_bi>POWER BI PRO)'
+    r'|(?P<power_automate_rpa>POWER AUTOMATE UNATTENDED RPA ADD-ON)'
+    r'|(?P<power_automate_plan>POWER AUTOMATE (?:PER USER WITH ATTENDED RPA PLAN|WITH ATT RPA PLAN))'
+    r'|(?P<teams_rooms>(?:MS|MICROSOFT) TEAMS ROOMS PRO)'
+    r'|(?P<teams_eea>(?:MS|MICROSOFT) TEAMS EEA)'
+    r'|(?P<copilot>(?:MS|MICROSOFT) COPILOT FOR (?:MS|MICROSOFT) 365|(?:MS|MICROSOFT) 365 COPILOT)'
+    r'|(?P<ms365_eea>(?:MS|MICROSOFT) 365 E3 EEA \(NO TEAMS\)|MICROSOFT 365 APPS FOR ENTERPRISE)'
+    r'|(?P<power_automate_prem>POWER AUTOMATE PREM\.?)'
+    r')'
+)
+
+# Gamla formatet (för bakåtkompatibilitet). Alla rader börjar med "CSP -" och har
+# samma svans, så licenstyperna slås ihop till ett mönster som körs i en enda
+# genomgång av texten. Den namngivna grupp som matchat anger licenstypen.
+_OLD_FORMAT_PATTERN = re.compile(
+    r'CSP -(?:'
+    r'(?P<power_bi>POWER BI PRO)'
+    r'|(?P<power_automate_rpa>POWER AUTOMATE UNATTENDED RPA ADD-ON)'
+    r'|(?P<power_automate_plan>POWER AUTOMATE WITH ATT RPA PLAN)'
+    r'|(?P<teams_rooms>MS TEAMS ROOMS PRO)'
+    r'|(?P<teams_eea>(?:MS|MICROSOFT) TEAMS EEA)'
+    r'|(?P<copilot>(?:(?:MS|MICROSOFT) COPILOT FOR (?:MS|MICROSOFT) 365|(?:MS|MICROSOFT) 365 COPILOT))'
+    r'|(?P<ms365_eea>(?:(?:MS|MICROSOFT) 365 E3 EEA \(NO TEAMS\)|MICROSOFT 365 APPS FOR ENTERPRISE))'
+    r'|(?P<power_automate_prem>POWER AUTOMATE PREM\.)'
+    r') \((?:CYCLE(?:FEE)?|CORRECTION|CORR|PURCHASEFEE)\)\s+\d{6}\s+-\s+\d{6}\s+(?P<quantity>\d+,\d+)\s+ST\s+(?P<unit_price>\d+[\s,]*\d*,\d+)\s+(?P<total>\d+[\s,]*\d*,\d+)'
+)
+
+# Kolumnrubriker i Medius-filen. Båda avgränsningskolumnerna har tom rubrik.
+_MEDIUS_COLUMNS = ('Kon/Proj', '', 'RG', 'Aktivitet', 'ProjAkt', 'ProjKat', '', 'Netto', 'Godkänt av')
+
+# Fakturatotalen matchas mot originaltexten (skiftlägeskänsligt)
+_INVOICE_TOTAL_PATTERN = re.compile(r'Summa Avtal.*?([\d\s]+,\d{2})')
+
+# Upplösning för rendering av PDF-sidor inför OCR. Kan inte alla licensrader tolkas
+# görs ett nytt försök med högre upplösning.
+_OCR_DPI = 150
+_OCR_RETRY_DPI = 300
+
+# Högsta antal sidor som OCR:as i ett Tesseract-anrop
+_OCR_MAX_BATCH_PAGES = 50
+
+# Kör bara Tesseracts LSTM-motor. Sidsegmenteringen (PSM) lämnas som standard
+# eftersom parsningen bygger på radordningen från den automatiska layoutanalysen.
+_TESSERACT_CONFIG = '--oem 1'
+
+# Gråskalevärde under vilket en pixel räknas som svart vid binarisering.
+# Uppslagstabellen låter PIL tröskla hela bilden i C utan ett Python-anrop per pixel.
+_BINARIZE_THRESHOLD = 180
+_BINARIZE_TABLE = [0 if value < _BINARIZE_THRESHOLD else 255 for value in range(256)]
+
+# Ingår i nyckeln för OCR-cachen så att cachad text inte återanvänds när
+# inställningarna eller OCR-motorn ändras
+_OCR_CACHE_KEY = (
+    f"dpi={_OCR_DPI},{_OCR_RETRY_DPI};binarize={_BINARIZE_THRESHOLD};config={_TESSERACT_CONFIG};"
+    f"engine={'tesserocr' if tesserocr is not None else 'tesseract'};lang=swe"
+)
+
+# Tar bort mellanslag och hårda mellanslag (tusentalsavgränsare) och gör
+# decimalkomma till punkt i ett steg
+_NUMBER_TRANSLATION = str.maketrans({' ': None, '\u00a0': None, ',': '.'})
+
+_SKU_MARKER = '/SKUS/'
+_OLD_FORMAT_MARKER = 'CSP -'
+_SKU_CODE_CHARS = frozenset(string.ascii_uppercase + string.digits)
+
+def _find_sku_rows(upper_text):
+    """Returnerar startpositionen för varje SKU-kod (nya formatet) i texten."""
+    row_starts = []
+    position = upper_text.find(_SKU_MARKER)
+    while position != -1:
+        # Backa till början av SKU-koden framför markören
+        start = position
+        while start > 0 and upper_text[start - 1] in _SKU_CODE_CHARS:
+            start -= 1
+        if start < position:
+            row_starts.append(start)
+        position = upper_text.find(_SKU_MARKER, position + len(_SKU_MARKER))
+    return row_starts
+
+# Standardinställningar för kända projekt som saknas i Project Settings.
+# Inställningarna är skrivskyddade eftersom samma objekt delas mellan anrop.
+_DEFAULT_PROJECT_SETTINGS = MappingProxyType({
+    '20257601': MappingProxyType({  # Automation
+        'Kon/Proj': 'P.20257601',
+        'Aktivitet': '050',
+        'ProjKat': '5420',
+        'Mottagare': 'Digital Utveckling och integration'
+    }),
+    '20257407': MappingProxyType({  # Microsoft 365
+        'Kon/Proj': 'P.20257407',
+        'Aktivitet': '738',
+        'ProjKat': '5420',
+        'Mottagare': 'Digital Arbetsplats'
+    }),
+    '20257403': MappingProxyType({  # Teams Room
+        'Kon/Proj': 'P.20257403',
+        'Aktivitet': '738',
+        'ProjKat': '5420',
+        'Mottagare': 'Digital Arbetsplats'
+    })
+})
+
+def _match_license_rows(text):
+    """Matchar licensraderna i båda fakturaformaten, grupperade per licenstyp."""
+    # Licensmönstren är skrivna i versaler, så texten görs om en gång
+    # i stället för att matcha skiftlägesokänsligt
+    upper_text = text.upper()
+    
+    # Nya formatet: SKU-raderna hittas med en snabb strängsökning och
+    # licensmönstret provas bara där, i stället för att söka igenom
+    # hela texten
+    new_format_matches = {}
+    for row_start in _find_sku_rows(upper_text):
+        match = _NEW_FORMAT_PATTERN.match(upper_text, row_start)
+        if match:
+            new_format_matches.setdefault(match.lastgroup, []).append(match.group('quantity', 'unit_price', 'total'))
+    
+    # Gamla formatet matchas för alla licenstyper i en genomgång
+    old_format_matches = {}
+    for match in _OLD_FORMAT_PATTERN.finditer(upper_text):
+        license_type = next(name for name in _LICENSE_TYPES if match.group(name) is not None)
+        old_format_matches.setdefault(license_type, []).append(match.group('quantity', 'unit_price', 'total'))
+    
+    return new_format_matches, old_format_matches
+
+def _has_license_rows(text):
+    """Avgör om licensmönstren hittar minst en rad i texten."""
+    new_format_matches, old_format_matches = _match_license_rows(text)
+    return bool(new_format_matches or old_format_matches)
+
+def _count_license_rows(text):
+    """Returnerar antal licensradsmarkörer och antal tolkade licensrader i texten."""
+    upper_text = text.upper()
+    marker_count = upper_text.count(_SKU_MARKER) + upper_text.count(_OLD_FORMAT_MARKER)
+    new_format_matches, old_format_matches = _match_license_rows(text)
+    parsed_count = sum(len(rows) for matches in (new_format_matches, old_format_matches) for rows in matches.values())
+    return marker_count, parsed_count
+
+def _all_license_rows_parsed(text):
+    """Avgör om texten har licensrader och om varje licensradsmarkör gav en tolkad rad."""
+    marker_count, parsed_count = _count_license_rows(text)
+    return parsed_count > 0 and parsed_count >= marker_count
+
+def _extract_text_layer(pdf_path):
+    """Returnerar PDF:ens textlager via pdftotext, eller en tom sträng om det inte kan läsas."""
+    try:
+        result = subprocess.run(
+            ['pdftotext', '-layout', '-enc', 'UTF-8', str(pdf_path), '-'],
+            capture_output=True,
+            check=True
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.debug("Kunde inte läsa textlagret med pdftotext: %s", e)
+        return ''
+    return result.stdout.decode('utf-8', errors='replace')
+
+def _binarize_page(image_path):
+    """Tröskelar en sidbild till 1 bit per pixel och skriver över filen."""
+    with Image.open(image_path) as image:
+        binary_image = image.convert('L').point(_BINARIZE_TABLE, '1')
+    binary_image.save(image_path)
+    return image_path
+
+class _AccountingRows:
+    """Samlar konteringsrader kolumnvis, en lista per varierande kolumn."""
+
+    __slots__ = ('kon_proj', 'rg', 'aktivitet', 'projkat', 'netto')
+
+    def __init__(self):
+        self.kon_proj = []
+        self.rg = []
+        self.aktivitet = []
+        self.projkat = []
+        self.netto = []
+
+    def add(self, kon_proj, netto, rg='', aktivitet='', projkat=''):
+        """Lägger till en konteringsrad."""
+        self.kon_proj.append(kon_proj)
+        self.rg.append(rg)
+        self.aktivitet.append(aktivitet)
+        self.projkat.append(projkat)
+        self.netto.append(netto)
+
+    def to_dataframe(self):
+        """Returnerar raderna som en DataFrame i Medius-format."""
+        return pd.DataFrame({
+            'Kon/Proj': self.kon_proj,
+            '': '',
+            'RG': self.rg,
+            'Aktivitet': self.aktivitet,
+            'ProjAkt': '',
+            'ProjKat': self.projkat,
+            ' ': '',
+            'Netto': self.netto,
+            'Godkänt av': 'John Munthe'
+        })
+
+def _json_default(obj):
+    """Konverterar NumPy-typer till JSON-serialiserbara typer."""
+    if hasattr(obj, 'item'):  # NumPy scalar
+        return obj.item()
+    raise TypeError(f"Objekt av typen {type(obj).__name__} kan inte serialiseras till JSON")
+
 class InvoiceHelper:
     def __init__(self):
+        _setup_logging()
+        
         self.users_file = 'data/users.xlsx'
         self.output_dir = 'output'
         self.users_data = None
         self.project_settings = None
+        self._project_index = {}
+        self._rg_user_counts = {}
+        self._automation_user_count = 0
+        self._pbi_users = None
         
         # Skapa output-mapp om den inte finns
         os.makedirs(self.output_dir, exist_ok=True)
@@ -37,8 +297,16 @@ class InvoiceHelper:
     def _load_excel_data(self):
         """Läser in data från Excel-filen."""
         try:
-            self.users_data = pd.read_excel(self.users_file, sheet_name='Power BI Users')
-            self.project_settings = pd.read_excel(self.users_file, sheet_name='Project Settings')
+            # Läs båda flikarna i ett anrop från samma öppnade arbetsbok.
+            # ProjektID läses som text direkt i stället för att konverteras efteråt.
+            sheets = pd.read_excel(
+                self.users_file,
+                sheet_name=['Power BI Users', 'Project Settings'],
+                engine=_EXCEL_READ_ENGINE,
+                dtype={'ProjektID': str}
+            )
+            self.users_data = sheets['Power BI Users']
+            self.project_settings = sheets['Project Settings']
             
             # Validera Project Settings-data
             required_columns = ['ProjektID', 'Kon/Proj', 'Aktivitet', 'ProjKat', 'Mottagare']
@@ -47,16 +315,38 @@ class InvoiceHelper:
                 logger.warning(f"Varning: Följande kolumner saknas i Project Settings: {', '.join(missing_columns)}")
             
             # Normalisera ProjektID (ta bort 'P.' om det finns)
-            self.project_settings['ProjektID'] = self.project_settings['ProjektID'].astype(str).apply(
-                lambda x: x.replace('P.', '') if x.startswith('P.') else x
-            )
+            self.project_settings['ProjektID'] = self.project_settings['ProjektID'].astype('string').str.removeprefix('P.')
+            
+            # Indexera projektinställningarna på ProjektID en gång, färdiga att
+            # användas i konteringen (första raden gäller vid dubbletter).
+            # Inställningarna är skrivskyddade eftersom samma objekt delas mellan anrop.
+            self._project_index = {}
+            for project in self.project_settings.to_dict('records'):
+                self._project_index.setdefault(project['ProjektID'], MappingProxyType({
+                    'Kon/Proj': f"P.{project['ProjektID']}",
+                    'Aktivitet': project['Aktivitet'],
+                    'ProjKat': project['ProjKat'],
+                    'Mottagare': project['Mottagare']
+                }))
+            
+            # Beräkna användargrupperingarna en gång, de ändras bara med Excel-filen.
+            # Power BI Pro-listan omfattar alla användare som inte är Automation
+            # (även de utan specialhantering), så samma urval används för båda.
+            is_automation = self.users_data['Specialhantering'] == 'Automation'
+            non_automation_users = self.users_data[~is_automation]
+            self._rg_user_counts = non_automation_users.groupby('RG').size().to_dict()
+            self._automation_user_count = int(is_automation.sum())
+            self._pbi_users = non_automation_users.sort_values(['RG', 'Namn'])
             
             logger.info("Excel-data inläst framgångsrikt")
             
-            # Logga tillgängliga projekt för felsökning
-            logger.info("Tillgängliga projekt i Project Settings:")
-            for _, row in self.project_settings.iterrows():
-                logger.info(f"- ProjektID: {row['ProjektID']}, Kon/Proj: {row['Kon/Proj']}, Aktivitet: {row['Aktivitet']}")
+            # Logga tillgängliga projekt för felsökning (tabellen formateras bara
+            # om debug-loggning är aktiv)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Tillgängliga projekt i Project Settings:\n%s",
+                    self.project_settings[['ProjektID', 'Kon/Proj', 'Aktivitet']].to_string(index=False)
+                )
             
         except Exception as e:
             logger.error(f"Fel vid inläsning av Excel-data: {str(e)}")
@@ -67,105 +357,154 @@ class InvoiceHelper:
         # Ta bort 'P.' från project_id om det finns
         search_id = project_id.replace('P.', '') if project_id.startswith('P.') else project_id
         
-        project = self.project_settings[self.project_settings['ProjektID'] == search_id]
+        project = self._project_index.get(search_id)
         
-        if project.empty:
+        if project is None:
             logger.warning(f"Kunde inte hitta inställningar för projekt {project_id}")
             # Returnera standardvärden baserat på projekttyp
-            default_settings = {
-                '20257601': {  # Automation
-                    'Kon/Proj': 'P.20257601',
-                    'Aktivitet': '050',
-                    'ProjKat': '5420',
-                    'Mottagare': 'Digital Utveckling och integration'
-                },
-                '20257407': {  # Microsoft 365
-                    'Kon/Proj': 'P.20257407',
-                    'Aktivitet': '738',
-                    'ProjKat': '5420',
-                    'Mottagare': 'Digital Arbetsplats'
-                },
-                '20257403': {  # Teams Room
-                    'Kon/Proj': 'P.20257403',
-                    'Aktivitet': '738',
-                    'ProjKat': '5420',
-                    'Mottagare': 'Digital Arbetsplats'
-                }
-            }
-            return default_settings.get(search_id, {
+            return _DEFAULT_PROJECT_SETTINGS.get(search_id, {
                 'Kon/Proj': f'P.{search_id}',
                 'Aktivitet': '738',
                 'ProjKat': '5420',
                 'Mottagare': 'Okänd mottagare'
             })
         
-        return {
-            'Kon/Proj': f"P.{project.iloc[0]['ProjektID']}",
-            'Aktivitet': project.iloc[0]['Aktivitet'],
-            'ProjKat': project.iloc[0]['ProjKat'],
-            'Mottagare': project.iloc[0]['Mottagare']
-        }
-
-    def extract_text_from_pdf(self, pdf_path):
-        """Extraherar text från PDF med OCR."""
+        return project
+
+    def extract_text_from_pdf(self, pdf_path, use_cache=True):
+        """Extraherar text från PDF, från textlagret eller med (cachad) OCR."""
         try:
-            # Konvertera PDF till bilder
-            images = convert_from_path(pdf_path)
+            text = _extract_text_layer(pdf_path)
+            if _has_license_rows(text):
+                logger.info("PDF:ens textlager innehåller licensrader, OCR behövs inte")
+                return text
             
-            # Extrahera text från varje sida
-            text_content = []
-            for i, image in enumerate(images):
-                logger.info(f"Processar sida {i+1}")
-                text = pytesseract.image_to_string(image, lang='swe')
-                text_content.append(text)
+            cache_path = None
+            if use_cache:
+                cache_path = self._ocr_cache_path(pdf_path)
+                if os.path.exists(cache_path):
+                    logger.info("Använder cachad OCR-text från %s", cache_path)
+                    with open(cache_path, encoding='utf-8') as f:
+                        return f.read()
             
-            return '\n'.join(text_content)
+            # Fler licensradsmarkörer än tolkade rader betyder att OCR:en
+            # förvanskat en eller flera rader
+            text = self._ocr_pdf(pdf_path)
+            if not _all_license_rows_parsed(text):
+                # Liten eller otydlig text kan kräva högre upplösning för att läsas
+                marker_count, parsed_count = _count_license_rows(text)
+                logger.warning("%s av %s licensrader kunde tolkas vid %s DPI, försöker igen med %s DPI",
+                               parsed_count, marker_count, _OCR_DPI, _OCR_RETRY_DPI)
+                text = self._ocr_pdf(pdf_path, dpi=_OCR_RETRY_DPI)
+                if not _all_license_rows_parsed(text):
+                    # Cacha inte en ofullständig tolkning, nästa körning ska OCR:a igen
+                    marker_count, parsed_count = _count_license_rows(text)
+                    logger.warning("%s av %s licensrader kunde tolkas vid %s DPI",
+                                   parsed_count, marker_count, _OCR_RETRY_DPI)
+                    return text
+            
+            if cache_path is not None:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                with open(cache_path, 'w', encoding='utf-8') as f:
+                    f.write(text)
+            return text
         except Exception as e:
             logger.error(f"Fel vid PDF-läsning: {str(e)}")
             raise
 
+    def _ocr_cache_path(self, pdf_path):
+        """Returnerar sökvägen till cachefilen för PDF:ens OCR-text."""
+        digest = hashlib.blake2b(Path(pdf_path).read_bytes(), digest_size=16)
+        digest.update(_OCR_CACHE_KEY.encode('utf-8'))
+        return os.path.join(self.output_dir, '.cache', f'{digest.hexdigest()}.txt')
+
+    def _ocr_pdf(self, pdf_path, dpi=_OCR_DPI):
+        """Renderar och OCR:ar alla sidor i PDF:en parallellt med given upplösning."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            page_count = pdfinfo_from_path(pdf_path)['Pages']
+            if not page_count:
+                return ''
+            
+            # Dela upp sidorna i ett sammanhängande sidintervall per tråd. Varje
+            # tråd renderar sitt intervall med pdftoppm och OCR:ar det direkt,
+            # så rendering och OCR av olika intervall överlappar. Både poppler
+            # och Tesseract körs i egna processer, så trådar räcker för att
+            # arbetet ska gå parallellt. executor.map behåller sidordningen.
+            # Intervallen begränsas till _OCR_MAX_BATCH_PAGES sidor så att långa
+            # bildlistor inte skickas till en och samma Tesseract-process.
+            max_workers = min(os.cpu_count() or 1, page_count)
+            batch_size = min(-(-page_count // max_workers), _OCR_MAX_BATCH_PAGES)
+            first_pages = range(1, page_count + 1, batch_size)
+            last_pages = [min(first_page + batch_size - 1, page_count) for first_page in first_pages]
+            
+            # Körs flera Tesseract-processer samtidigt begränsas var och en till en
+            # OpenMP-tråd så att de inte konkurrerar om samma kärnor. Gränsen sätts
+            # bara under den parallella körningen och bara om användaren inte satt
+            # en egen. tesserocr läser gränsen redan när biblioteket laddas, så med
+            # tesserocr får OMP_THREAD_LIMIT sättas innan programmet startas.
+            limit_omp_threads = len(first_pages) > 1 and 'OMP_THREAD_LIMIT' not in os.environ
+            if limit_omp_threads:
+                os.environ['OMP_THREAD_LIMIT'] = '1'
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    text_content = list(executor.map(
+                        self._ocr_batch,
+                        [pdf_path] * len(first_pages), first_pages, last_pages,
+                        [tmp_dir] * len(first_pages), [dpi] * len(first_pages)
+                    ))
+            finally:
+                if limit_omp_threads:
+                    del os.environ['OMP_THREAD_LIMIT']
+        
+        return '\n'.join(text_content)
+
+    def _ocr_batch(self, pdf_path, first_page, last_page, tmp_dir, dpi):
+        """Renderar ett sidintervall och kör OCR på det med en laddning av språkmodellen."""
+        logger.info("Processar sida %s-%s", first_page, last_page)
+        image_paths = convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            grayscale=True,
+            first_page=first_page,
+            last_page=last_page,
+            output_folder=tmp_dir,
+            paths_only=True
+        )
+        image_paths = [_binarize_page(image_path) for image_path in image_paths]
+        if tesserocr is not None:
+            # PyTessBaseAPI är inte trådsäkert, så varje batch (tråd) får ett eget
+            with tesserocr.PyTessBaseAPI(lang='swe', oem=tesserocr.OEM.LSTM_ONLY) as api:
+                page_texts = []
+                for image_path in image_paths:
+                    api.SetImageFile(image_path)
+                    page_texts.append(api.GetUTF8Text())
+            return '\f'.join(page_texts)
+        
+        list_path = os.path.join(tmp_dir, f'pages_{first_page:03d}.txt')
+        with open(list_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(image_paths))
+        
+        return pytesseract.image_to_string(list_path, lang='swe', config=_TESSERACT_CONFIG)
+
     def parse_license_info(self, text):
         """Extraherar licensinformation från OCR-texten."""
         try:
             logger.info("Börjar parsning av licensinformation")
             
-            # Först försök med nya formatet (SKU-kod + produktnamn på två rader)
-            # Nya formatet: SKU-rad med periodtyp, sedan indenterad produktnamn-rad
-            new_format_patterns = {
-                'power_bi': r'[A-Z0-9]+/skus/\d+\s+-\s+(?:Cycle(?:Fee)?|Correction|Corr|PurchaseFee)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)\s*[\r\n]+\s*Power BI Pro',
-                'power_automate_rpa': r'[A-Z0-9]+/skus/\d+\s+-\s+(?:Cycle(?:Fee)?|Correction|Corr|PurchaseFee)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)\s*[\r\n]+\s*Power Automate unattended RPA add-on',
-                'power_automate_plan': r'[A-Z0-9]+/skus/\d+\s+-\s+(?:Cycle(?:Fee)?|Correction|Corr|PurchaseFee)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)\s*[\r\n]+\s*Power Automate (?:per user with attended RPA plan|with att RPA plan)',
-                'teams_rooms': r'[A-Z0-9]+/skus/\d+\s+-\s+(?:Cycle(?:Fee)?|Correction|Corr|PurchaseFee)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)\s*[\r\n]+\s*(?:MS|Microsoft) Teams Rooms Pro',
-                'teams_eea': r'[A-Z0-9]+/skus/\d+\s+-\s+(?:Cycle(?:Fee)?|Correction|Corr|PurchaseFee)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)\s*[\r\n]+\s*(?:MS|Microsoft) Teams EEA',
-                'copilot': r'[A-Z0-9]+/skus/\d+\s+-\s+(?:Cycle(?:Fee)?|Correction|Corr|PurchaseFee)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)\s*[\r\n]+\s*(?:(?:MS|Microsoft) Copilot for (?:MS|Microsoft) 365|(?:MS|Microsoft) 365 Copilot)',
-                'ms365_eea': r'[A-Z0-9]+/skus/\d+\s+-\s+(?:Cycle(?:Fee)?|Correction|Corr|PurchaseFee)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)\s*[\r\n]+\s*(?:(?:MS|Microsoft) 365 E3 EEA \(no Teams\)|Microsoft 365 Apps for enterprise)',
-                'power_automate_prem': r'[A-Z0-9]+/skus/\d+\s+-\s+(?:Cycle(?:Fee)?|Correction|Corr|PurchaseFee)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)\s*[\r\n]+\s*Power Automate prem\.?'
-            }
-            
-            # Gamla formatet (för bakåtkompatibilitet)
-            old_format_patterns = {
-                'power_bi': r'CSP -Power BI Pro \((?:Cycle(?:fee)?|Correction|Corr|PurchaseFee)\)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)',
-                'power_automate_rpa': r'CSP -Power Automate unattended RPA add-on \((?:Cycle(?:fee)?|Correction|Corr|PurchaseFee)\)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)',
-                'teams_rooms': r'CSP -MS Teams Rooms Pro \((?:Cycle(?:fee)?|Correction|Corr|PurchaseFee)\)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)',
-                'power_automate_plan': r'CSP -Power Automate with att RPA plan \((?:Cycle(?:fee)?|Correction|Corr|PurchaseFee)\)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)',
-                'teams_eea': r'CSP -(?:MS|Microsoft) Teams EEA \((?:Cycle(?:fee)?|Correction|Corr|PurchaseFee)\)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)',
-                'copilot': r'CSP -(?:(?:MS|Microsoft) Copilot for (?:MS|Microsoft) 365|(?:MS|Microsoft) 365 Copilot) \((?:Cycle(?:fee)?|Correction|Corr|PurchaseFee)\)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)',
-                'ms365_eea': r'CSP -(?:(?:MS|Microsoft) 365 E3 EEA \(no Teams\)|Microsoft 365 Apps for enterprise) \((?:Cycle(?:fee)?|Correction|Corr|PurchaseFee)\)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)',
-                'power_automate_prem': r'CSP -Power Automate prem\. \((?:Cycle(?:fee)?|Correction|Corr|PurchaseFee)\)\s+\d{6}\s+-\s+\d{6}\s+(\d+,\d+)\s+ST\s+(\d+[\s,]*\d*,\d+)\s+(\d+[\s,]*\d*,\d+)'
-            }
+            new_format_matches, old_format_matches = _match_license_rows(text)
             
             # Extrahera information för varje licenstyp - matcha både nya och gamla formatet
             license_info = {}
-            for license_type in new_format_patterns.keys():
+            for license_type in _LICENSE_TYPES:
                 all_matches = []
                 
-                # Försök matcha nya formatet först
-                new_matches = re.findall(new_format_patterns[license_type], text, re.IGNORECASE | re.MULTILINE)
+                # Träffar från nya formatet först
+                new_matches = new_format_matches.get(license_type)
                 if new_matches:
                     all_matches.extend(new_matches)
                 
-                # Försök matcha gamla formatet
-                old_matches = re.findall(old_format_patterns[license_type], text, re.IGNORECASE | re.MULTILINE)
+                # Lägg till träffar från gamla formatet
+                old_matches = old_format_matches.get(license_type)
                 if old_matches:
                     all_matches.extend(old_matches)
                 
@@ -177,9 +516,9 @@ class InvoiceHelper:
                     for match in all_matches:
                         quantity, unit_price, total = match
                         # Rensa och konvertera värden
-                        quantity = float(quantity.replace(' ', '').replace(',', '.'))
-                        unit_price = float(unit_price.replace(' ', '').replace(',', '.'))
-                        total = float(total.replace(' ', '').replace(',', '.'))
+                        quantity = float(quantity.translate(_NUMBER_TRANSLATION))
+                        unit_price = float(unit_price.translate(_NUMBER_TRANSLATION))
+                        total = float(total.translate(_NUMBER_TRANSLATION))
                         
                         total_quantity += quantity
                         total_amount += total
@@ -198,10 +537,10 @@ class InvoiceHelper:
                     logger.warning(f"Kunde inte hitta information för {license_type}")
 
             # Extrahera fakturatotalen
-            total_match = re.search(r'Summa Avtal.*?([\d\s]+,\d{2})', text)
+            total_match = _INVOICE_TOTAL_PATTERN.search(text)
             invoice_total = None
             if total_match:
-                invoice_total = float(total_match.group(1).replace(' ', '').replace(',', '.'))
+                invoice_total = float(total_match.group(1).translate(_NUMBER_TRANSLATION))
                 logger.info(f"Hittade fakturatotal: {invoice_total} kr")
             else:
                 logger.warning("Kunde inte hitta fakturatotal i texten")
@@ -211,12 +550,6 @@ class InvoiceHelper:
             if not license_info:
                 raise ValueError("Ingen licensinformation hittades i texten")
             
-            # Spara parsed data som backup
-            self.save_backup(
-                {'license_info': license_info},
-                f'parsed_licenses_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-            )
-            
             return license_info
             
         except Exception as e:
@@ -227,43 +560,27 @@ class InvoiceHelper:
         """Genererar konteringsrader baserat på licensinformation."""
         try:
             logger.info("Börjar generera konteringsrader")
-            accounting_rows = []
+            accounting_rows = _AccountingRows()
             
             # 1. Hantera Power BI Pro-licenser (förutom Mattias)
             if 'power_bi' in license_info:
                 power_bi_info = license_info['power_bi']
                 
-                # Gruppera användare per RG
-                non_automation_users = self.users_data[self.users_data['Specialhantering'] != 'Automation']
-                rg_groups = non_automation_users.groupby('RG')
-                
-                for rg, group in rg_groups:
-                    num_users = len(group)
+                # Användare per RG (förberäknat vid inläsning)
+                for rg, num_users in self._rg_user_counts.items():
                     if num_users > 0:
-                        row = {
-                            'Kon/Proj': '5420',
-                            '': '',
-                            'RG': rg,
-                            'Aktivitet': '738',
-                            'ProjAkt': '',
-                            'ProjKat': '',
-                            ' ': '',
-                            'Netto': round(num_users * power_bi_info['unit_price'], 2),
-                            'Godkänt av': 'John Munthe'
-                        }
-                        accounting_rows.append(row)
-                        logger.info(f"Lade till Power BI Pro-kontering för RG {rg}: {num_users} användare")
+                        accounting_rows.add('5420', round(num_users * power_bi_info['unit_price'], 2), rg=rg, aktivitet='738')
+                        logger.info("Lade till Power BI Pro-kontering för RG %s: %s användare", rg, num_users)
             
             # 2. Hantera Automation-projekt (20257601)
             automation_total = 0
             
             # Lägg till Mattias Power BI Pro-licens
             if 'power_bi' in license_info:
-                automation_users = self.users_data[self.users_data['Specialhantering'] == 'Automation']
-                num_automation_users = len(automation_users)
+                num_automation_users = self._automation_user_count
                 if num_automation_users > 0:
                     automation_total += num_automation_users * license_info['power_bi']['unit_price']
-                    logger.info(f"Lade till Power BI Pro-licens för {num_automation_users} automation-användare")
+                    logger.info("Lade till Power BI Pro-licens för %s automation-användare", num_automation_users)
             
             # Lägg till övriga automation-licenser
             if 'power_automate_rpa' in license_info:
@@ -275,19 +592,13 @@ class InvoiceHelper:
             
             # Hämta automation-projektinställningar
             automation_settings = self.get_project_settings('20257601')
-            automation_row = {
-                'Kon/Proj': automation_settings['Kon/Proj'],
-                '': '',
-                'RG': '',
-                'Aktivitet': automation_settings['Aktivitet'],
-                'ProjAkt': '',
-                'ProjKat': automation_settings['ProjKat'],
-                ' ': '',
-                'Netto': round(automation_total, 2),
-                'Godkänt av': 'John Munthe'
-            }
-            accounting_rows.append(automation_row)
-            logger.info(f"Lade till Automation-projektkontering: {automation_total} kr")
+            accounting_rows.add(
+                automation_settings['Kon/Proj'],
+                round(automation_total, 2),
+                aktivitet=automation_settings['Aktivitet'],
+                projkat=automation_settings['ProjKat']
+            )
+            logger.info("Lade till Automation-projektkontering: %s kr", automation_total)
             
             # 3. Hantera Microsoft 365-projekt (20257407)
             ms365_total = 0
@@ -301,75 +612,66 @@ class InvoiceHelper:
             
             # Hämta MS365-projektinställningar
             ms365_settings = self.get_project_settings('20257407')
-            ms365_row = {
-                'Kon/Proj': ms365_settings['Kon/Proj'],
-                '': '',
-                'RG': '',
-                'Aktivitet': ms365_settings['Aktivitet'],
-                'ProjAkt': '',
-                'ProjKat': ms365_settings['ProjKat'],
-                ' ': '',
-                'Netto': round(ms365_total, 2),
-                'Godkänt av': 'John Munthe'
-            }
-            accounting_rows.append(ms365_row)
-            logger.info(f"Lade till Microsoft 365-projektkontering: {ms365_total} kr")
+            accounting_rows.add(
+                ms365_settings['Kon/Proj'],
+                round(ms365_total, 2),
+                aktivitet=ms365_settings['Aktivitet'],
+                projkat=ms365_settings['ProjKat']
+            )
+            logger.info("Lade till Microsoft 365-projektkontering: %s kr", ms365_total)
             
             # 4. Hantera Teams Room-projekt (20257403)
             if 'teams_rooms' in license_info:
                 # Hämta Teams-projektinställningar
                 teams_settings = self.get_project_settings('20257403')
-                teams_row = {
-                    'Kon/Proj': teams_settings['Kon/Proj'],
-                    '': '',
-                    'RG': '',
-                    'Aktivitet': teams_settings['Aktivitet'],
-                    'ProjAkt': '',
-                    'ProjKat': teams_settings['ProjKat'],
-                    ' ': '',
-                    'Netto': round(license_info['teams_rooms']['total'], 2),
-                    'Godkänt av': 'John Munthe'
-                }
-                accounting_rows.append(teams_row)
-                logger.info(f"Lade till Teams Room-projektkontering: {license_info['teams_rooms']['total']} kr")
-            
-            return accounting_rows
+                accounting_rows.add(
+                    teams_settings['Kon/Proj'],
+                    round(license_info['teams_rooms']['total'], 2),
+                    aktivitet=teams_settings['Aktivitet'],
+                    projkat=teams_settings['ProjKat']
+                )
+                logger.info("Lade till Teams Room-projektkontering: %s kr", license_info['teams_rooms']['total'])
+            
+            return accounting_rows.to_dataframe()
             
         except Exception as e:
-            logger.error(f"Fel vid generering av konteringsrader: {str(e)}")
+            logger.error("Fel vid generering av konteringsrader: %s", e)
             raise
 
     def save_to_excel(self, accounting_rows, output_file):
         """Sparar konteringsrader till Excel i Medius-format."""
         try:
-            df = pd.DataFrame(accounting_rows, columns=[
-                'Kon/Proj', '', 'RG', 'Aktivitet', 'ProjAkt', 'ProjKat', '', 'Netto', 'Godkänt av'
-            ])
-            df.to_excel(output_file, index=False)
+            # Skriv raderna i ordning direkt med xlsxwriter, utan att gå via
+            # pandas Excel-export. Eftersom raderna skrivs en i taget kan
+            # constant_memory användas så att varje rad skrivs ut direkt.
+            # Saknade värden (NaN) lämnas tomma, som i pandas Excel-export.
+            with xlsxwriter.Workbook(output_file, {'constant_memory': True}) as workbook:
+                worksheet = workbook.add_worksheet()
+                worksheet.write_row(0, 0, _MEDIUS_COLUMNS)
+                for row_number, row in enumerate(accounting_rows.itertuples(index=False, name=None), start=1):
+                    worksheet.write_row(row_number, 0, ['' if pd.isna(value) else value for value in row])
             logger.info(f"Konteringsrader sparade till {output_file}")
         except Exception as e:
             logger.error(f"Fel vid sparande av konteringsrader: {str(e)}")
             raise
 
-    def _convert_to_serializable(self, obj):
-        """Konverterar NumPy-typer till JSON-serialiserbara typer."""
-        if isinstance(obj, dict):
-            return {key: self._convert_to_serializable(value) for key, value in obj.items()}
-        elif isinstance(obj, list):
-            return [self._convert_to_serializable(item) for item in obj]
-        elif hasattr(obj, 'item'):  # NumPy scalar
-            return obj.item()
-        return obj
-
     def save_backup(self, data, filename):
         """Sparar backup av data som JSON."""
         try:
-            # Konvertera data till JSON-serialiserbart format
-            serializable_data = self._convert_to_serializable(data)
-            
+            # NumPy-typer konverteras av _json_default när kodaren stöter på dem,
+            # så datastrukturen behöver inte kopieras i förväg
             backup_path = os.path.join(self.output_dir, filename)
-            with open(backup_path, 'w', encoding='utf-8') as f:
-                json.dump(serializable_data, f, ensure_ascii=False, indent=2)
+            if orjson is not None:
+                # orjson kodar direkt till UTF-8-bytes i samma format som json nedan
+                with open(backup_path, 'wb') as f:
+                    f.write(orjson.dumps(
+                        data,
+                        default=_json_default,
+                        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+                    ))
+            else:
+                with open(backup_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2, default=_json_default)
             logger.info(f"Backup sparad till {backup_path}")
         except Exception as e:
             logger.error(f"Fel vid sparande av backup: {str(e)}")
@@ -380,75 +682,87 @@ class InvoiceHelper:
         try:
             logger.info("\n=== VALIDERING AV KONTERINGSRADER ===")
             
+            # Konteringsraderna väljs ut direkt ur kolumnerna, utan en dict per rad
+            kon_proj = accounting_rows['Kon/Proj']
+            comments = accounting_rows['Kommentar'].fillna('').astype(str).str.lower() if 'Kommentar' in accounting_rows else None
+            
+            def netto_values(key, comment_word=None):
+                # Nettobelopp för raderna på Kon/Proj, ev. bara de vars kommentar innehåller ordet
+                mask = kon_proj == key
+                if comment_word is not None:
+                    if comments is None:
+                        return []
+                    mask &= comments.str.contains(comment_word, regex=False)
+                return accounting_rows.loc[mask, 'Netto'].tolist()
+            
             # 1. Summera Power BI Pro-konteringar (RG-baserade)
-            power_bi_total = sum(row['Netto'] for row in accounting_rows if row['Kon/Proj'] == '5420')
-            logger.info(f"\nPower BI Pro-konteringar per RG:")
-            for row in accounting_rows:
-                if row['Kon/Proj'] == '5420':
-                    logger.info(f"RG {row['RG']}: {row['Netto']} kr")
-            logger.info(f"Totalt Power BI Pro (RG): {power_bi_total} kr")
+            rg_rows = accounting_rows.loc[kon_proj == '5420', ['RG', 'Netto']]
+            rg_netto = rg_rows['Netto'].tolist()
+            power_bi_total = sum(rg_netto)
+            logger.info("\nPower BI Pro-konteringar per RG:")
+            for rg, netto in zip(rg_rows['RG'].tolist(), rg_netto):
+                logger.info("RG %s: %s kr", rg, netto)
+            logger.info("Totalt Power BI Pro (RG): %s kr", power_bi_total)
             
             # 2. Validera automationslicenser
-            automation_row = next(row for row in accounting_rows if row['Kon/Proj'] == 'P.20257601')
-            automation_total = automation_row['Netto']
+            automation_total = netto_values('P.20257601')[0]
             
-            logger.info(f"\nAutomationslicenser (P.20257601):")
+            logger.info("\nAutomationslicenser (P.20257601):")
             if 'power_automate_rpa' in license_info:
-                logger.info(f"Power Automate RPA: {license_info['power_automate_rpa']['total']} kr")
+                logger.info("Power Automate RPA: %s kr", license_info['power_automate_rpa']['total'])
             if 'power_automate_plan' in license_info:
-                logger.info(f"Power Automate Plan: {license_info['power_automate_plan']['total']} kr")
+                logger.info("Power Automate Plan: %s kr", license_info['power_automate_plan']['total'])
             if 'power_automate_prem' in license_info:
-                logger.info(f"Power Automate Prem: {license_info['power_automate_prem']['total']} kr")
+                logger.info("Power Automate Prem: %s kr", license_info['power_automate_prem']['total'])
             
-            automation_users = self.users_data[self.users_data['Specialhantering'] == 'Automation']
-            if len(automation_users) > 0 and 'power_bi' in license_info:
-                logger.info(f"Power BI Pro (Automation): {len(automation_users) * license_info['power_bi']['unit_price']} kr")
+            num_automation_users = self._automation_user_count
+            if num_automation_users > 0 and 'power_bi' in license_info:
+                logger.info("Power BI Pro (Automation): %s kr", num_automation_users * license_info['power_bi']['unit_price'])
             
-            logger.info(f"Totalt Automation: {automation_total} kr")
+            logger.info("Totalt Automation: %s kr", automation_total)
             
             # 3. Validera Microsoft 365-licenser
-            ms365_row = next(row for row in accounting_rows if row['Kon/Proj'] == 'P.20257407')
-            ms365_total = ms365_row['Netto']
+            ms365_total = netto_values('P.20257407')[0]
             
-            logger.info(f"\nMicrosoft 365-licenser (P.20257407):")
+            logger.info("\nMicrosoft 365-licenser (P.20257407):")
             if 'teams_eea' in license_info:
-                logger.info(f"Teams EEA: {license_info['teams_eea']['total']} kr")
+                logger.info("Teams EEA: %s kr", license_info['teams_eea']['total'])
             if 'copilot' in license_info:
-                logger.info(f"Copilot: {license_info['copilot']['total']} kr")
+                logger.info("Copilot: %s kr", license_info['copilot']['total'])
             if 'ms365_eea' in license_info:
-                logger.info(f"MS365 EEA: {license_info['ms365_eea']['total']} kr")
-            logger.info(f"Totalt Microsoft 365: {ms365_total} kr")
+                logger.info("MS365 EEA: %s kr", license_info['ms365_eea']['total'])
+            logger.info("Totalt Microsoft 365: %s kr", ms365_total)
             
             # 4. Validera Teams Room-licenser
             teams_proj = 'P.20257403'
             teams_lic = license_info.get('teams_rooms')
             if teams_lic:
-                teams_row = next((row for row in accounting_rows if row['Kon/Proj'] == teams_proj), None)
-                if teams_row:
+                teams_netto = netto_values(teams_proj)
+                if teams_netto:
                     # Validera summan
                     expected = round(teams_lic['total'] * teams_lic['unit_price'], 2)
-                    actual = round(teams_row['Netto'], 2)
+                    actual = round(teams_netto[0], 2)
                     if expected == actual:
-                        logger.info(f"Teams Room ({teams_proj}): {actual} kr [OK]")
+                        logger.info("Teams Room (%s): %s kr [OK]", teams_proj, actual)
                     else:
-                        logger.warning(f"Teams Room ({teams_proj}): {actual} kr, förväntat {expected} kr [FEL]")
+                        logger.warning("Teams Room (%s): %s kr, förväntat %s kr [FEL]", teams_proj, actual, expected)
                 else:
-                    logger.warning(f"Ingen konteringsrad hittades för Teams Rooms ({teams_proj}) trots att licensraden finns.")
+                    logger.warning("Ingen konteringsrad hittades för Teams Rooms (%s) trots att licensraden finns.", teams_proj)
             else:
-                logger.info(f"Ingen Teams Rooms-licens på fakturan, hoppar över validering för {teams_proj}.")
+                logger.info("Ingen Teams Rooms-licens på fakturan, hoppar över validering för %s.", teams_proj)
 
             # 5. Validera totalsumma
-            total_sum = sum(row['Netto'] for row in accounting_rows)
+            total_sum = sum(accounting_rows['Netto'].tolist())
             invoice_total = license_info.get('invoice_total')
-            logger.info(f"\n=== SUMMERING ===")
-            logger.info(f"Totalsumma från konteringsrader: {total_sum} kr")
+            logger.info("\n=== SUMMERING ===")
+            logger.info("Totalsumma från konteringsrader: %s kr", total_sum)
             if invoice_total is not None:
-                logger.info(f"Fakturatotal från PDF: {invoice_total} kr")
+                logger.info("Fakturatotal från PDF: %s kr", invoice_total)
                 if abs(total_sum - invoice_total) <= 0.02:
                     logger.info("[OK] Totalsumman stämmer med fakturan")
                 else:
                     # ANSI escape code för röd text: \033[91m ... \033[0m
-                    logger.error(f"\033[91m[FEL] Totalsumman från konteringsrader: {total_sum} kr, fakturatotal: {invoice_total} kr (DIFFERENS: {total_sum-invoice_total} kr)\033[0m")
+                    logger.error("\033[91m[FEL] Totalsumman från konteringsrader: %s kr, fakturatotal: %s kr (DIFFERENS: %s kr)\033[0m", total_sum, invoice_total, total_sum-invoice_total)
             else:
                 logger.warning("Ingen fakturatotal tillgänglig för validering.")
             
@@ -461,13 +775,13 @@ class InvoiceHelper:
                 (license_info.get('power_automate_plan', {}).get('total', 0)) +
                 (license_info.get('power_automate_prem', {}).get('total', 0))
             )
-            if len(automation_users) > 0 and 'power_bi' in license_info:
-                expected_automation += len(automation_users) * license_info['power_bi']['unit_price']
+            if num_automation_users > 0 and 'power_bi' in license_info:
+                expected_automation += num_automation_users * license_info['power_bi']['unit_price']
             
             if abs(automation_total - expected_automation) <= 0.02:
                 logger.info("[OK] Automationssumman stämmer")
             else:
-                logger.warning(f"[!] Differens i automationssumma: {automation_total - expected_automation} kr")
+                logger.warning("[!] Differens i automationssumma: %s kr", automation_total - expected_automation)
             
             # Beräkna förväntad MS365-summa
             expected_ms365 = (
@@ -479,17 +793,17 @@ class InvoiceHelper:
             if abs(ms365_total - expected_ms365) <= 0.02:
                 logger.info("[OK] Microsoft 365-summan stämmer")
             else:
-                logger.warning(f"[!] Differens i Microsoft 365-summa: {ms365_total - expected_ms365} kr")
+                logger.warning("[!] Differens i Microsoft 365-summa: %s kr", ms365_total - expected_ms365)
             
             # Validera Teams Room
             expected_teams = license_info.get('teams_rooms', {}).get('total', 0)
-            teams_row = next((row for row in accounting_rows if row['Kon/Proj'] == 'P.20257403'), None)
-            if teams_row:
-                teams_total = teams_row['Netto']
+            teams_netto = netto_values('P.20257403')
+            if teams_netto:
+                teams_total = teams_netto[0]
                 if abs(teams_total - expected_teams) <= 0.02:
                     logger.info("[OK] Teams Room-summan stämmer")
                 else:
-                    logger.warning(f"[!] Differens i Teams Room-summa: {teams_total - expected_teams} kr")
+                    logger.warning("[!] Differens i Teams Room-summa: %s kr", teams_total - expected_teams)
             else:
                 logger.info("Ingen Teams Room-rad i konteringen, hoppar över validering av Teams Room-summa.")
 
@@ -497,57 +811,57 @@ class InvoiceHelper:
             copilot_proj = 'P.20257407'
             copilot_lic = license_info.get('copilot')
             if copilot_lic:
-                copilot_row = next((row for row in accounting_rows if row['Kon/Proj'] == copilot_proj and 'copilot' in row.get('Kommentar', '').lower()), None)
-                if copilot_row:
+                copilot_netto = netto_values(copilot_proj, 'copilot')
+                if copilot_netto:
                     expected = round(copilot_lic['total'] * copilot_lic['unit_price'], 2)
-                    actual = round(copilot_row['Netto'], 2)
+                    actual = round(copilot_netto[0], 2)
                     if expected == actual:
-                        logger.info(f"Copilot ({copilot_proj}): {actual} kr [OK]")
+                        logger.info("Copilot (%s): %s kr [OK]", copilot_proj, actual)
                     else:
-                        logger.warning(f"Copilot ({copilot_proj}): {actual} kr, förväntat {expected} kr [FEL]")
+                        logger.warning("Copilot (%s): %s kr, förväntat %s kr [FEL]", copilot_proj, actual, expected)
                 else:
-                    logger.warning(f"Ingen konteringsrad hittades för Copilot ({copilot_proj}) trots att licensraden finns.")
+                    logger.warning("Ingen konteringsrad hittades för Copilot (%s) trots att licensraden finns.", copilot_proj)
             else:
-                logger.info(f"Ingen Copilot-licens på fakturan, hoppar över validering för {copilot_proj}.")
+                logger.info("Ingen Copilot-licens på fakturan, hoppar över validering för %s.", copilot_proj)
 
             # MS365 EEA
             ms365_proj = 'P.20257407'
             ms365_lic = license_info.get('ms365_eea')
             if ms365_lic:
-                ms365_row = next((row for row in accounting_rows if row['Kon/Proj'] == ms365_proj and 'ms365' in row.get('Kommentar', '').lower()), None)
-                if ms365_row:
+                ms365_netto = netto_values(ms365_proj, 'ms365')
+                if ms365_netto:
                     expected = round(ms365_lic['total'] * ms365_lic['unit_price'], 2)
-                    actual = round(ms365_row['Netto'], 2)
+                    actual = round(ms365_netto[0], 2)
                     if expected == actual:
-                        logger.info(f"MS365 EEA ({ms365_proj}): {actual} kr [OK]")
+                        logger.info("MS365 EEA (%s): %s kr [OK]", ms365_proj, actual)
                     else:
-                        logger.warning(f"MS365 EEA ({ms365_proj}): {actual} kr, förväntat {expected} kr [FEL]")
+                        logger.warning("MS365 EEA (%s): %s kr, förväntat %s kr [FEL]", ms365_proj, actual, expected)
                 else:
-                    logger.warning(f"Ingen konteringsrad hittades för MS365 EEA ({ms365_proj}) trots att licensraden finns.")
+                    logger.warning("Ingen konteringsrad hittades för MS365 EEA (%s) trots att licensraden finns.", ms365_proj)
             else:
-                logger.info(f"Ingen MS365 EEA-licens på fakturan, hoppar över validering för {ms365_proj}.")
+                logger.info("Ingen MS365 EEA-licens på fakturan, hoppar över validering för %s.", ms365_proj)
 
             # Power Automate Prem
             prem_proj = 'P.20257601'
             prem_lic = license_info.get('power_automate_prem')
             if prem_lic:
-                prem_row = next((row for row in accounting_rows if row['Kon/Proj'] == prem_proj and 'prem' in row.get('Kommentar', '').lower()), None)
-                if prem_row:
+                prem_netto = netto_values(prem_proj, 'prem')
+                if prem_netto:
                     expected = round(prem_lic['total'] * prem_lic['unit_price'], 2)
-                    actual = round(prem_row['Netto'], 2)
+                    actual = round(prem_netto[0], 2)
                     if expected == actual:
-                        logger.info(f"Power Automate Prem ({prem_proj}): {actual} kr [OK]")
+                        logger.info("Power Automate Prem (%s): %s kr [OK]", prem_proj, actual)
                     else:
-                        logger.warning(f"Power Automate Prem ({prem_proj}): {actual} kr, förväntat {expected} kr [FEL]")
+                        logger.warning("Power Automate Prem (%s): %s kr, förväntat %s kr [FEL]", prem_proj, actual, expected)
                 else:
-                    logger.warning(f"Ingen konteringsrad hittades för Power Automate Prem ({prem_proj}) trots att licensraden finns.")
+                    logger.warning("Ingen konteringsrad hittades för Power Automate Prem (%s) trots att licensraden finns.", prem_proj)
             else:
-                logger.info(f"Ingen Power Automate Prem-licens på fakturan, hoppar över validering för {prem_proj}.")
+                logger.info("Ingen Power Automate Prem-licens på fakturan, hoppar över validering för %s.", prem_proj)
             
             logger.info("\n=== VALIDERING SLUTFÖRD ===")
             
         except Exception as e:
-            logger.error(f"Fel vid validering av konteringsrader: {str(e)}")
+            logger.error("Fel vid validering av konteringsrader: %s", e)
             raise
 
     def generate_invoice_comment(self, license_info, accounting_rows):
@@ -557,16 +871,14 @@ class InvoiceHelper:
         # 1. Power BI Pro-användare
         logger.info("Genererar Power BI Pro-användarlista")
         try:
-            # Filtrera användare som inte är markerade för specialhantering
-            pbi_users = self.users_data[
-                (self.users_data['Specialhantering'].isna()) | 
-                (self.users_data['Specialhantering'] != 'Automation')
-            ].sort_values(['RG', 'Namn'])
+            # Användare som inte är markerade för specialhantering (förberäknat vid inläsning)
+            pbi_users = self._pbi_users
             
             if not pbi_users.empty:
                 comment_parts.append("\nPower BI Pro-licenser")
-                for _, user in pbi_users.iterrows():
-                    comment_parts.append(f"{user['Namn']}\t{user['RG']}:{user['Kostnadsställe']}")
+                # Gå igenom de tre kolumnerna direkt i stället för att bygga en Series per rad
+                for name, rg, cost_center in zip(pbi_users['Namn'], pbi_users['RG'], pbi_users['Kostnadsställe']):
+                    comment_parts.append(f"{name}\t{rg}:{cost_center}")
         except Exception as e:
             logger.error(f"Fel vid generering av Power BI Pro-användarlista: {str(e)}")
             raise
@@ -583,16 +895,12 @@ class InvoiceHelper:
         if 'power_automate_prem' in license_info:
             automation_licenses.append("Power Automate prem")
         
-        automation_users = self.users_data[self.users_data['Specialhantering'] == 'Automation']
-        if not automation_users.empty:
+        if self._automation_user_count > 0:
             automation_licenses.append("Power BI Pro (Mattias)")
         
         if automation_licenses:
-            # Hämta mottagare från Project Settings
-            automation_project = self.project_settings[self.project_settings['ProjektID'] == '20257601']
-            receiver = 'Digital Utveckling och integration'  # Standard
-            if not automation_project.empty and 'Mottagare' in automation_project.columns:
-                receiver = automation_project.iloc[0]['Mottagare']
+            # Hämta mottagare från Project Settings (standardvärde om projektet saknas)
+            receiver = self._project_index.get('20257601', {}).get('Mottagare', 'Digital Utveckling och integration')
             license_by_receiver[receiver] = automation_licenses
         
         # Microsoft 365/Digital Arbetsplats
@@ -605,20 +913,14 @@ class InvoiceHelper:
             ms365_licenses.append("MS 365 E3 EEA (no Teams)")
         
         if ms365_licenses:
-            # Hämta mottagare från Project Settings
-            ms365_project = self.project_settings[self.project_settings['ProjektID'] == '20257407']
-            receiver = 'Digital Arbetsplats'  # Standard
-            if not ms365_project.empty and 'Mottagare' in ms365_project.columns:
-                receiver = ms365_project.iloc[0]['Mottagare']
+            # Hämta mottagare från Project Settings (standardvärde om projektet saknas)
+            receiver = self._project_index.get('20257407', {}).get('Mottagare', 'Digital Arbetsplats')
             license_by_receiver[receiver] = ms365_licenses
         
         # Teams Room/Digital Arbetsplats
         if 'teams_rooms' in license_info:
-            # Hämta mottagare från Project Settings
-            teams_project = self.project_settings[self.project_settings['ProjektID'] == '20257403']
-            receiver = 'Digital Arbetsplats'  # Standard
-            if not teams_project.empty and 'Mottagare' in teams_project.columns:
-                receiver = teams_project.iloc[0]['Mottagare']
+            # Hämta mottagare från Project Settings (standardvärde om projektet saknas)
+            receiver = self._project_index.get('20257403', {}).get('Mottagare', 'Digital Arbetsplats')
             
             if receiver in license_by_receiver:
                 license_by_receiver[receiver].append("MS Teams Rooms Pro")
@@ -633,29 +935,30 @@ class InvoiceHelper:
 
     def process_invoice(self, pdf_path):
         """Huvudfunktion för att processa en faktura."""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        backup_filename = f"invoice_backup_{timestamp}.json"
+        backup = {}
+        backup_attempted = False
         try:
             logger.info(f"Börjar processa faktura: {pdf_path}")
             
             # Extrahera text från PDF
             ocr_text = self.extract_text_from_pdf(pdf_path)
-            
-            # Spara backup av OCR-text
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.save_backup(ocr_text, f"ocr_backup_{timestamp}.json")
+            backup['ocr_text'] = ocr_text
             
             # Parsa licensinformation
             logger.info("Börjar parsning av licensinformation")
             license_info = self.parse_license_info(ocr_text)
-            
-            # Spara backup av parsad licensinformation
-            self.save_backup(license_info, f"parsed_licenses_{timestamp}.json")
+            backup['license_info'] = license_info
             
             # Generera konteringsrader
             logger.info("Börjar generera konteringsrader")
             accounting_rows = self.generate_accounting_rows(license_info)
+            backup['accounting_rows'] = accounting_rows.to_dict('records')
             
-            # Spara backup av konteringsrader
-            self.save_backup(accounting_rows, f"accounting_rows_{timestamp}.json")
+            # Spara backup av OCR-text, licensinformation och konteringsrader
+            backup_attempted = True
+            self.save_backup(backup, backup_filename)
             
             # Validera konteringsrader
             self.validate_accounting_rows(accounting_rows, license_info)
@@ -676,26 +979,34 @@ class InvoiceHelper:
             
         except Exception as e:
             logger.error(f"Fel vid processning av faktura: {str(e)}")
+            if backup and not backup_attempted:
+                # Spara det som hunnit tas fram, t.ex. OCR-texten, för felsökning
+                self.save_backup(backup, backup_filename)
             raise
 
 def main():
+    _setup_logging()
     try:
         # Skapa en instans av InvoiceHelper
         helper = InvoiceHelper()
         
-        # Använd tkinter för att välja PDF-fil
-        import tkinter as tk
-        from tkinter import filedialog
-        
-        root = tk.Tk()
-        root.withdraw()  # Dölj huvudfönstret
-        
-        print("\nVälj PDF-fil med Atea-faktura...")
-        pdf_path = filedialog.askopenfilename(
-            title="Välj Atea-faktura (PDF)",
-            filetypes=[("PDF-filer", "*.pdf")],
-            initialdir="C:/Users/Public/downloads"  # Ändrat till Public downloads-mappen
-        )
+        if len(sys.argv) > 1:
+            # PDF-filen angavs på kommandoraden
+            pdf_path = sys.argv[1]
+        else:
+            # Använd tkinter för att välja PDF-fil (importeras bara när dialogen behövs)
+            import tkinter as tk
+            from tkinter import filedialog
+            
+            root = tk.Tk()
+            root.withdraw()  # Dölj huvudfönstret
+            
+            print("\nVälj PDF-fil med Atea-faktura...")
+            pdf_path = filedialog.askopenfilename(
+                title="Välj Atea-faktura (PDF)",
+                filetypes=[("PDF-filer", "*.pdf")],
+                initialdir="C:/Users/Public/downloads"  # Ändrat till Public downloads-mappen
+            )
         
         if not pdf_path:
             print("Ingen fil valdes. Avslutar.")